@@ -1,9 +1,10 @@
 import streamlit as st
 import sys
 import os
-import io  # Needed for in-memory file creation
+import html  # Needed to escape LLM-generated text in tag markup
+import time  # Needed for polling background analyses
+from concurrent.futures import ThreadPoolExecutor  # Needed for background analyses
 from datetime import datetime  # Needed for smart filenames
-from docx import Document  # Needed for .docx creation
 
 # --- Path Setup ---
 # Add the 'src' directory to the Python path
@@ -11,94 +12,160 @@ from docx import Document  # Needed for .docx creation
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 try:
-    from src.backend import agent
-    from src.backend.rate_limiter import SimpleRateLimiter
+    from src.backend import agent, config
+    from src.backend.docx_writer import build_docx
+    from src.backend.rate_limiter import RedisRateLimiter, SimpleRateLimiter
 except ImportError:
     st.error("Error: Could not import the backend agent. Make sure 'src/backend/agent.py' exists.")
     st.stop()
 
 
+# How often to check on a background analysis
+_POLL_INTERVAL_SECONDS = 0.5
+
+
 # --- Internal Helper Functions ---
+@st.cache_resource
+def _get_executor():
+    """Returns the thread pool (shared by all sessions) that runs agent analyses."""
+    return ThreadPoolExecutor(max_workers=4)
+
+
 def _generate_filename_prefix():
     """Generates a clean, timestamped filename prefix."""
     now = datetime.now()
     return f"patent_analysis_{now.strftime('%Y%m%d_%H%M%S')}"
 
 
-def _create_docx(content):
-    """Creates an in-memory .docx file from the report text."""
-    doc = Document()
-    doc.add_heading('Patent Analysis Report', 0)
+@st.cache_data(show_spinner=False, max_entries=16)
+def _create_docx(content: str) -> bytes:
+    """Creates an in-memory .docx file from the report text (cached per report)."""
+    # One paragraph per line preserves line breaks; the XML is streamed
+    # straight into the zip instead of building a full document in memory
+    return build_docx(content, title='Patent Analysis Report')
 
-    # Add the full report as paragraphs
-    # This preserves line breaks
-    for line in content.split('\n'):
-        doc.add_paragraph(line)
 
-    # Save to an in-memory buffer
-    buffer = io.BytesIO()
-    doc.save(buffer)
-    buffer.seek(0)
-    return buffer.getvalue()
+def _render_download_buttons(final_report, file_prefix):
+    """Renders the .txt/.md/.docx download buttons."""
+    # Use columns to place buttons side-by-side
+    col1, col2, col3 = st.columns(3)
+
+    with col1:
+        st.download_button(
+            label="Download as Text (.txt)",
+            data=final_report,
+            file_name=f"{file_prefix}.txt",
+            mime="text/plain"
+        )
+
+    with col2:
+        st.download_button(
+            label="Download as Markdown (.md)",
+            data=final_report,
+            file_name=f"{file_prefix}.md",
+            mime="text/markdown"
+        )
+
+    with col3:
+        # Create the docx file in memory (cached, so it's only built once per report)
+        docx_data = _create_docx(final_report)
+        st.download_button(
+            label="Download as Word (.docx)",
+            data=docx_data,
+            file_name=f"{file_prefix}.docx",
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+        )
+
+
+# --- Static Markup ---
+# Built once at import time rather than on every rerun
+_BUTTON_CSS = """
+<style>
+div.stButton > button:first-child {
+    background-color: #4CAF50; /* Green */
+    color: white;
+    border: none;
+    padding: 10px 20px;
+    text-align: center;
+    text-decoration: none;
+    display: inline-block;
+    font-size: 16px;
+    margin: 4px 2px;
+    cursor: pointer;
+    border-radius: 8px;
+}
+div.stButton > button:first-child:hover {
+    background-color: #45a049; /* Darker green */
+}
+</style>
+"""
+
+# Section headers for the search strategy panel (HTML heading + markdown blockquote)
+_KEYWORDS_SECTION_HEADER = (
+    "<h3 style='text-align: center;'>Technical Keywords & Synonyms</h3>"
+    "\n\n> Use these terms for your own research on Google Patents."
+)
+
+_CPC_SECTION_HEADER = (
+    "<h3 style='text-align: center;'>Relevant CPC Codes</h3>"
+    "<p style='text-align: center; font-size: 0.9em; color: #666;'>CPC stands for 'Cooperative Patent Classification'. "
+    "This is a professional, expert-level 'tag' used to categorize patents. You can paste these codes directly into "
+    "Google Patents to find all patents in that specific category.</p>"
+    "\n\n> These are the 'expert-level' classifications for this technology."
+)
+
+_HYDE_SECTION_HEADER = (
+    "<h3 style='text-align: center;'>Generated HyDE Abstract</h3>"
+    "<p style='text-align: center; font-size: 0.9em; color: #666;'>HyDE stands for 'Hypothetical Document Embedding'. "
+    "The AI writes this \"perfect\" abstract for a patent that matches your idea. It then converts this abstract into "
+    "a vector in hopes to find the most semantically similar patents in the database.</p>"
+    "\n\n> This is the 'hypothetical patent' the AI used to search for semantic matches."
+)
 
 
 # --- Helper for displaying artifacts ---
+# Tag markup templates (filled with an html-escaped keyword or CPC code)
+_KW_TAG = "<span style='background-color: #eee; border-radius: 5px; padding: 3px 8px; margin: 3px; display: inline-block;'>%s</span>"
+_CPC_TAG = "<span style='background-color: #e0f2fe; border-radius: 5px; padding: 3px 8px; margin: 3px; display: inline-block;'>%s</span>"
+# One column of tags: bold label, blank line, then the joined tags
+_TAG_COLUMN = "**%s**\n\n%s"
+
+
+def _tags_column(label, tag_template, items):
+    """Builds the markup for one column of tags: a bold label followed by the tags."""
+    return _TAG_COLUMN % (label, "".join(tag_template % html.escape(item) for item in items))
+
+
 def _display_artifacts_side_by_side(base_artifacts, novel_artifacts):
-    """Helper to neatly display keywords, CPCs, and HyDE abstract side by side."""
+    """
+    Helper to neatly display keywords, CPCs, and HyDE abstract side by side.
+    Each header and each column is sent as a single markdown element.
+    """
 
     # Technical Keywords & Synonyms
-    st.markdown("<h3 style='text-align: center;'>Technical Keywords & Synonyms</h3>", unsafe_allow_html=True)
-    st.markdown("> Use these terms for your own research on Google Patents.")
+    st.markdown(_KEYWORDS_SECTION_HEADER, unsafe_allow_html=True)
 
     col1, col2 = st.columns(2)
-
-    with col1:
-        st.markdown("**Base Technology Search**")
-        base_keywords = base_artifacts.get('technical_keywords', [])
-        tags_html = "".join([
-            f"<span style='background-color: #eee; border-radius: 5px; padding: 3px 8px; margin: 3px; display: inline-block;'>{kw}</span>"
-            for kw in base_keywords])
-        st.markdown(tags_html, unsafe_allow_html=True)
-
-    with col2:
-        st.markdown("**Novel Features Search**")
-        novel_keywords = novel_artifacts.get('technical_keywords', [])
-        tags_html = "".join([
-            f"<span style='background-color: #eee; border-radius: 5px; padding: 3px 8px; margin: 3px; display: inline-block;'>{kw}</span>"
-            for kw in novel_keywords])
-        st.markdown(tags_html, unsafe_allow_html=True)
+    col1.markdown(_tags_column("Base Technology Search", _KW_TAG, base_artifacts.get('technical_keywords', [])),
+                  unsafe_allow_html=True)
+    col2.markdown(_tags_column("Novel Features Search", _KW_TAG, novel_artifacts.get('technical_keywords', [])),
+                  unsafe_allow_html=True)
 
     st.divider()
 
     # Relevant CPC Codes
-    st.markdown("<h3 style='text-align: center;'>Relevant CPC Codes</h3>", unsafe_allow_html=True)
-    st.markdown("<p style='text-align: center; font-size: 0.9em; color: #666;'>CPC stands for 'Cooperative Patent Classification'. This is a professional, expert-level 'tag' used to categorize patents. You can paste these codes directly into Google Patents to find all patents in that specific category.</p>", unsafe_allow_html=True)
-    st.markdown("> These are the 'expert-level' classifications for this technology.")
+    st.markdown(_CPC_SECTION_HEADER, unsafe_allow_html=True)
 
     col1, col2 = st.columns(2)
-
-    with col1:
-        st.markdown("**Base Technology Search**")
-        base_cpcs = base_artifacts.get('cpc_codes', [])
-        tags_html = "".join([
-            f"<span style='background-color: #e0f2fe; border-radius: 5px; padding: 3px 8px; margin: 3px; display: inline-block;'>{cpc}</span>"
-            for cpc in base_cpcs])
-        st.markdown(tags_html, unsafe_allow_html=True)
-
-    with col2:
-        st.markdown("**Novel Features Search**")
-        novel_cpcs = novel_artifacts.get('cpc_codes', [])
-        tags_html = "".join([
-            f"<span style='background-color: #e0f2fe; border-radius: 5px; padding: 3px 8px; margin: 3px; display: inline-block;'>{cpc}</span>"
-            for cpc in novel_cpcs])
-        st.markdown(tags_html, unsafe_allow_html=True)
+    col1.markdown(_tags_column("Base Technology Search", _CPC_TAG, base_artifacts.get('cpc_codes', [])),
+                  unsafe_allow_html=True)
+    col2.markdown(_tags_column("Novel Features Search", _CPC_TAG, novel_artifacts.get('cpc_codes', [])),
+                  unsafe_allow_html=True)
 
     st.divider()
 
     # Generated HyDE Abstract
-    st.markdown("<h3 style='text-align: center;'>Generated HyDE Abstract</h3>", unsafe_allow_html=True)
-    st.markdown("<p style='text-align: center; font-size: 0.9em; color: #666;'>HyDE stands for 'Hypothetical Document Embedding'. The AI writes this \"perfect\" abstract for a patent that matches your idea. It then converts this abstract into a vector in hopes to find the most semantically similar patents in the database.</p>", unsafe_allow_html=True)
-    st.markdown("> This is the 'hypothetical patent' the AI used to search for semantic matches.")
+    st.markdown(_HYDE_SECTION_HEADER, unsafe_allow_html=True)
 
     col1, col2 = st.columns(2)
 
@@ -111,6 +178,41 @@ def _display_artifacts_side_by_side(base_artifacts, novel_artifacts):
         st.info(novel_artifacts.get('hyde_abstract', 'N/A'))
 
 
+@st.fragment
+def _render_analysis(analysis_result, file_prefix):
+    """
+    Renders a finished analysis: the report, the search strategy, and the download buttons.
+    Runs as a fragment, so interacting with it (e.g. downloading) only reruns this block,
+    not the whole page.
+    """
+    final_report = analysis_result["final_report"]
+    search_artifacts = analysis_result["search_artifacts"]
+
+    # --- Display Final Report ---
+    # st.header("Analysis Report")
+    st.markdown("<h3 style='text-align: center; text-decoration: underline;'>Analysis Report</h3>",
+                unsafe_allow_html=True)
+    st.markdown(final_report)
+
+    # --- Display Intermediate Search Strategy ---
+    with st.expander("See AI Search Strategy (Click to Open)"):
+        st.markdown(
+            "This is how the AI interpreted your idea to search the patent database. You can use these artifacts for your own research as well.")
+
+        base_artifacts = search_artifacts.get("base_technology_search", {})
+        novel_artifacts = search_artifacts.get("novel_features_search", {})
+
+        _display_artifacts_side_by_side(base_artifacts, novel_artifacts)
+
+    # --- Copy Final Report ---
+    with st.expander("Copy Report Text"):
+        st.code(final_report, language="markdown")
+
+    # --- Download Buttons ---
+    st.subheader("Download Report")
+    _render_download_buttons(final_report, file_prefix)
+
+
 # --- Page Configuration ---
 st.set_page_config(
     page_title="Patent Prior Art Analyst",
@@ -119,8 +221,17 @@ st.set_page_config(
 )
 
 # --- Rate Limiter Setup ---
-# Initialize rate limiter: 5 queries per session
-rate_limiter = SimpleRateLimiter(max_queries_per_session=5)
+# Initialize rate limiter: 5 queries per hour, with bursts of up to 5
+# Use Redis when configured so the limit is shared across all workers/replicas
+if config.REDIS_URL:
+    rate_limiter = RedisRateLimiter(
+        config.REDIS_URL,
+        capacity=5,
+        refill_rate=5 / 3600,
+        fallback_to_session=config.RATE_LIMIT_SESSION_FALLBACK
+    )
+else:
+    rate_limiter = SimpleRateLimiter(capacity=5, refill_rate=5 / 3600)
 
 # --- Page Title & Description ---
 st.title("Patent & Prior Art Analyst Agent")
@@ -141,6 +252,19 @@ st.divider()
 rate_limiter.show_usage_indicator()
 
 # --- Usage Limits Info ---
+# Describe the limiter that's actually active
+if isinstance(rate_limiter, RedisRateLimiter):
+    limit_scope = """
+    - Your query allowance is tied to your network address, so refreshing the page doesn't reset it
+    - Failed analyses don't count against your allowance
+    """
+else:
+    limit_scope = """
+    - Your query allowance is tied to your browser session
+    - Failed analyses don't count against your allowance
+    - This is a "soft limit" that relies on honest usage
+    """
+
 with st.expander("ℹ️ About Usage Limits"):
     st.markdown("""
     **Why are there usage limits?**
@@ -148,15 +272,12 @@ with st.expander("ℹ️ About Usage Limits"):
     This app uses advanced AI models and vector databases which have associated costs.
     To keep the service free and available for everyone, I've implemented fair usage limits:
 
-    - **5 queries per browser session** - Each session gets 5 free analyses
-    - **Refresh for more** - You can refresh your browser to start a new session
+    - **5 queries per hour** - You can run up to 5 analyses back to back
+    - **Queries refill over time** - One new query becomes available roughly every 12 minutes
     - **Please use responsibly** - This is a free service, so users are trusted to be fair
 
     **How it works:**
-    - Your query counter is tied to your browser session
-    - After 5 queries, you'll need to refresh the page to continue
-    - This is a "soft limit" that relies on honest usage
-    """)
+    """ + limit_scope)
 
 st.divider()
 
@@ -170,109 +291,76 @@ user_description = st.text_area(
 
 # --- Button Styling (Safer Injection) ---
 # Inject the custom CSS for the button
-st.markdown(
-    """
-<style>
-div.stButton > button:first-child {
-    background-color: #4CAF50; /* Green */
-    color: white;
-    border: none;
-    padding: 10px 20px;
-    text-align: center;
-    text-decoration: none;
-    display: inline-block;
-    font-size: 16px;
-    margin: 4px 2px;
-    cursor: pointer;
-    border-radius: 8px;
-}
-div.stButton > button:first-child:hover {
-    background-color: #45a049; /* Darker green */
-}
-</style>
-""",
-    unsafe_allow_html=True
-)
+st.markdown(_BUTTON_CSS, unsafe_allow_html=True)
 
 # --- Analysis Button Logic ---
 # Use a standard 'st.button' check, which is more reliable
-if st.button("Analyze Prior Art"):
+# The button is disabled while an analysis is already running for this session
+analysis_running = "analysis_future" in st.session_state
+if st.button("Analyze Prior Art", disabled=analysis_running):
     if not user_description.strip():
         st.warning("Please enter a description of your invention.")
     elif not rate_limiter.can_query():
-        st.error("⛔ Session limit reached (5 queries used). Please refresh your browser to start a new session with 5 fresh queries.")
+        st.error(rate_limiter.get_usage_message())
     else:
-        # Show a spinner while the agent is working
+        # Run the agent in the background so the page stays responsive.
+        # The agent reports its search strategy through 'progress' as soon as it's ready.
+        progress = {}
+        st.session_state.analysis_progress = progress
+        st.session_state.analysis_future = _get_executor().submit(
+            agent.cached_run_analysis,
+            user_description,
+            on_search_artifacts=lambda artifacts: progress.update(search_artifacts=artifacts)
+        )
+        st.session_state.pop("last_analysis", None)
+        st.session_state.pop("last_prefix", None)
+
+# --- Background Analysis Polling ---
+if "analysis_future" in st.session_state:
+    future = st.session_state.analysis_future
+
+    if not future.done():
+        # Show the search strategy early, while retrieval and synthesis are still running
+        partial_artifacts = st.session_state.analysis_progress.get("search_artifacts")
+        if partial_artifacts:
+            with st.expander("See AI Search Strategy (Click to Open)"):
+                _display_artifacts_side_by_side(
+                    partial_artifacts.get("base_technology_search", {}),
+                    partial_artifacts.get("novel_features_search", {})
+                )
+
+        # Show a spinner while the agent is working, then poll again
         with st.spinner("Agent is analyzing... This may take a moment."):
-            try:
-                # Call agent and get dictionary
-                analysis_result = agent.run_analysis(user_description)
-
-                # Check for errors
-                if "error" in analysis_result:
-                    st.error(analysis_result["error"])
-                    st.stop()
-
-                # Increment query counter after successful analysis
-                rate_limiter.increment()
-
-                final_report = analysis_result["final_report"]
-                search_artifacts = analysis_result["search_artifacts"]
-
-                # --- Display Final Report ---
-                # st.header("Analysis Report")
-                st.markdown("<h3 style='text-align: center; text-decoration: underline;'>Analysis Report</h3>",
-                            unsafe_allow_html=True)
-                st.markdown(final_report)
-
-                # --- Display Intermediate Search Strategy ---
-                with st.expander("See AI Search Strategy (Click to Open)"):
-                    st.markdown(
-                        "This is how the AI interpreted your idea to search the patent database. You can use these artifacts for your own research as well.")
-
-                    base_artifacts = search_artifacts.get("base_technology_search", {})
-                    novel_artifacts = search_artifacts.get("novel_features_search", {})
-
-                    _display_artifacts_side_by_side(base_artifacts, novel_artifacts)
-
-                # --- Copy Final Report ---
-                with st.expander("Copy Report Text"):
-                    st.code(final_report, language="markdown")
-
-                # --- Download Buttons ---
-                st.subheader("Download Report")
-
-                # Generate a single, unique filename prefix (using updated function name)
-                file_prefix = _generate_filename_prefix()
-
-                # Use columns to place buttons side-by-side
-                col1, col2, col3 = st.columns(3)
-
-                with col1:
-                    st.download_button(
-                        label="Download as Text (.txt)",
-                        data=final_report,
-                        file_name=f"{file_prefix}.txt",
-                        mime="text/plain"
-                    )
-
-                with col2:
-                    st.download_button(
-                        label="Download as Markdown (.md)",
-                        data=final_report,
-                        file_name=f"{file_prefix}.md",
-                        mime="text/markdown"
-                    )
-
-                with col3:
-                    # Create the docx file in memory (using updated function name)
-                    docx_data = _create_docx(final_report)
-                    st.download_button(
-                        label="Download as Word (.docx)",
-                        data=docx_data,
-                        file_name=f"{file_prefix}.docx",
-                        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                    )
-
-            except Exception as e:
-                st.error(f"An error occurred during analysis: {e}")
+            time.sleep(_POLL_INTERVAL_SECONDS)
+        st.rerun()
+
+    del st.session_state.analysis_future
+    del st.session_state.analysis_progress
+
+    try:
+        # Get the agent's result dictionary
+        analysis_result, cache_hit = future.result()
+
+        # Check for errors (failed analyses don't use up a query)
+        if "error" in analysis_result:
+            rate_limiter.refund()
+            st.error(analysis_result["error"])
+            st.stop()
+
+        # Cached results cost nothing upstream, so they don't use up a query either
+        if cache_hit:
+            rate_limiter.refund()
+
+        # Keep the results so reruns (e.g. download clicks) don't re-run the agent
+        # (the filename prefix is fixed here so it doesn't change on every rerun)
+        st.session_state.last_analysis = analysis_result
+        st.session_state.last_prefix = _generate_filename_prefix()
+
+    except Exception as e:
+        rate_limiter.refund()
+        st.error(f"An error occurred during analysis: {e}")
+
+# --- Results Area ---
+# Rendered from session state so the report survives reruns triggered by other widgets
+if "last_analysis" in st.session_state:
+    _render_analysis(st.session_state.last_analysis, st.session_state.last_prefix)
@@ -1,9 +1,17 @@
 import sys
 import os
+import argparse
+import hashlib
+import itertools
+import multiprocessing
+import queue
+import threading
 import time
-from google.cloud import bigquery
-from pinecone import Pinecone
-from langchain_openai import OpenAIEmbeddings
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import numpy as np
+from google.cloud import bigquery, bigquery_storage
+from pinecone.grpc import PineconeGRPC
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from tqdm import tqdm  # For a nice progress bar
 
@@ -11,7 +19,7 @@ from tqdm import tqdm  # For a nice progress bar
 # This allows us to import from 'src.backend'
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 try:
-    from src.backend import config
+    from src.backend import compression, config, llm_client
 except ImportError:
     print("Error: Could not import config.py. Make sure you are running this from the root directory.")
     sys.exit(1)
@@ -78,9 +86,45 @@ WHERE
 LIMIT 80000;
 """
 
+# Chunking
+CHUNK_SIZE = 500  # Max characters per chunk
+CHUNK_OVERLAP = 50  # Characters shared between neighbouring chunks
+CHUNK_WORKERS = os.cpu_count() or 1  # Worker processes splitting windows into chunks (CPU-bound)
+
+
+# Incremental ingestion: one key per upserted chunk (vector id + hash of its text and CPC codes),
+# plus one "<patent id>#<chunk count>" line whenever a patent's chunk count changes
+CHECKPOINT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "embedded.log")
+CHECKPOINT_COUNT_SEPARATOR = "#"
+
+# Metadata compression (only when ZSTD_DICT_PATH is set)
+ZSTD_SAMPLE_BYTES = 10_000_000  # Chunk text sampled from the first windows to train the dictionary
+
 # Batch sizes for efficiency
-EMBED_BATCH_SIZE = 100  # Number of texts to embed at once
-PINECONE_BATCH_SIZE = 100  # Number of vectors to upsert at once
+# OpenAI accepts up to 2048 inputs (and 300k tokens) per embedding request;
+# 512 chunks of ~500 chars stays well under both while cutting round-trips 5x
+EMBED_BATCH_SIZE = 512  # Number of texts to embed at once
+EMBED_WORKERS = 16  # Number of embedding requests in flight at once
+
+# Streaming
+# Patents chunked, embedded and upserted together (bounds peak memory). Every patent
+# yields at least one chunk, so a window fills all EMBED_WORKERS embedding requests.
+INGEST_WINDOW_SIZE = EMBED_BATCH_SIZE * EMBED_WORKERS
+UPSERT_QUEUE_SIZE = 4  # Embedded windows allowed to wait for upserting (bounds peak memory)
+# Pinecone accepts up to 1000 vectors (and 2 MB) per upsert request;
+# see upsert_batch_size() for how the actual batch size is chosen
+PINECONE_MAX_BATCH_SIZE = 1000
+PINECONE_MAX_REQUEST_BYTES = 2_000_000
+PINECONE_AVG_METADATA_BYTES = 1500  # Rough size of one vector's id + metadata (chunk text, CPC codes)
+
+# OpenAI client settings
+OPENAI_MAX_RETRIES = 8  # Retries (with exponential backoff) on rate limits / transient errors
+# OpenAI embedding rate limits (match these to your account's usage tier).
+# Requests wait for budget up front instead of being rejected with 429s and retried.
+OPENAI_REQUESTS_PER_MINUTE = 3000
+OPENAI_TOKENS_PER_MINUTE = 1_000_000
+OPENAI_REQUEST_BURST = 50  # Requests that may be sent back-to-back while budget allows
+CHARS_PER_TOKEN = 4  # Rough English text estimate, used to budget tokens before sending
 
 
 # --- Helper Functions ---
@@ -91,13 +135,17 @@ def initialize_clients():
     try:
         # Assumes GOOGLE_APPLICATION_CREDENTIALS env var is set
         bq_client = bigquery.Client()
+        # The Storage Read API streams results as Arrow record batches (instead of
+        # JSON rows over REST), so rows are decoded in bulk by pyarrow
+        bqstorage_client = bigquery_storage.BigQueryReadClient()
         print("  BigQuery client initialized.")
     except Exception as e:
         print(f"  Error initializing BigQuery (check GOOGLE_APPLICATION_CREDENTIALS): {e}")
-        return None, None, None, None
+        return None, None, None, None, None
 
     try:
-        pc = Pinecone(api_key=config.PINECONE_API_KEY)
+        # The gRPC client uses HTTP/2 multiplexing and protobuf instead of JSON over REST
+        pc = PineconeGRPC(api_key=config.PINECONE_API_KEY)
         index_name = config.PINECONE_INDEX_NAME
 
         # First, check if the index actually exists.
@@ -106,12 +154,21 @@ def initialize_clients():
             print(f"  Index '{index_name}' does NOT exist in your Pinecone project.")
             print(f"  Please check your .env file (PINECONE_INDEX_NAME) and the Pinecone console.")
             print(f"  Available indexes: {pc.list_indexes().names()}")
-            return None, None, None, None
+            return None, None, None, None, None
 
         # We must create the index object *before* we can use it
         index = pc.Index(index_name)
         print(f"  Pinecone index '{index_name}' successfully found.")
 
+        # Every upsert would fail if the embeddings don't fit the index
+        index_dimension = index.describe_index_stats().dimension
+        if config.EMBEDDING_DIMENSIONS and index_dimension != config.EMBEDDING_DIMENSIONS:
+            print(f"  ---!! FATAL ERROR !! ---")
+            print(f"  Index '{index_name}' has dimension {index_dimension}, "
+                  f"but EMBEDDING_DIMENSIONS is {config.EMBEDDING_DIMENSIONS}.")
+            print(f"  Recreate the index with dimension {config.EMBEDDING_DIMENSIONS} or update your .env file.")
+            return None, None, None, None, None
+
         # # Clear out any old data
         # print("  Clearing all old data from Pinecone index...")
         # index.delete(delete_all=True)
@@ -119,127 +176,664 @@ def initialize_clients():
 
     except Exception as e:
         print(f"  Error initializing Pinecone: {e}")
-        return None, None, None, None
+        return None, None, None, None, None
 
-    embeddings = OpenAIEmbeddings(
-        model=config.EMBEDDING_MODEL,
-        openai_api_key=config.OPENAI_API_KEY
+    # Runs on the app's pooled HTTP client (llm_client.HTTP_MAX_CONNECTIONS keep-alive
+    # connections), so the TLS handshake happens once per connection, not once per batch
+    embeddings = llm_client.create_embedding_model(
+        max_retries=OPENAI_MAX_RETRIES  # The OpenAI SDK backs off exponentially between retries
     )
     print("  Embedding model initialized.")
 
     text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=50
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP
     )
     print("  Text splitter initialized.")
 
-    return bq_client, index, embeddings, text_splitter
+    return bq_client, bqstorage_client, index, embeddings, text_splitter
 
 
 def fetch_data_from_bigquery(client, query):
-    """Queries BigQuery and returns the results."""
+    """
+    Queries BigQuery and returns the (not yet downloaded) query results.
+    Use `iter_patent_windows()` to stream the rows.
+    """
     print(f"Running BigQuery query... (This may take a moment, it's processing TBs of data)")
     try:
         query_job = client.query(query)  # Make API request
         results = query_job.result()  # Wait for the job to complete
-        total_rows = results.total_rows
-        print(f"  Query complete. Fetched {total_rows} patents.")
-        return list(results)
+        print(f"  Query complete. Streaming {results.total_rows} patents.")
+        return results
     except Exception as e:
         print(f"  Error running BigQuery query: {e}")
-        return []
+        return None
+
+
+def iter_patent_windows(results, bqstorage_client):
+    """
+    Streams query results as windows of INGEST_WINDOW_SIZE patents (the last one
+    may be smaller).
+
+    Rows arrive from the Storage Read API as Arrow record batches of varying size;
+    each batch is converted column by column to Python lists, and rows are regrouped
+    across batches so every window is full.
+
+    Yields:
+        dict: Column name -> list of values (struct-of-arrays), one entry per patent.
+    """
+    columns = ("publication_number", "title", "abstract", "cpc_codes")
+    buffer = {name: [] for name in columns}
+    for record_batch in results.to_arrow_iterable(bqstorage_client=bqstorage_client):
+        for name in columns:
+            buffer[name].extend(record_batch.column(name).to_pylist())
+        while len(buffer["publication_number"]) >= INGEST_WINDOW_SIZE:
+            yield {name: values[:INGEST_WINDOW_SIZE] for name, values in buffer.items()}
+            buffer = {name: values[INGEST_WINDOW_SIZE:] for name, values in buffer.items()}
+    if buffer["publication_number"]:
+        yield buffer
+
+
+def chunk_patents(patents, text_splitter):
+    """
+    Splits a window of patents (columns from `iter_patent_windows()`) into chunks.
+
+    Per-chunk metadata is kept as parallel columns (patent_ids, cpc_lists) that
+    reference the patent's own objects; the metadata dicts are only built when
+    the vectors are upserted (see `build_vector_batch()`).
+
+    Returns:
+        tuple: Parallel lists (ids, texts, patent_ids, cpc_lists) with one entry per chunk.
+    """
+    ids, texts, patent_ids, cpc_lists_by_chunk = [], [], [], []
+
+    publication_numbers = patents["publication_number"]
+    # Handle potential None values from BigQuery
+    texts_to_embed = [
+        f"Title: {title or ''}\nAbstract: {abstract or ''}"
+        for title, abstract in zip(patents["title"], patents["abstract"])
+    ]
+    # This is critical: split the comma-separated string back into a list, keeping only
+    # the distinct 4-character subclasses (e.g., 'G06N3/08' -> 'G06N') that queries filter on
+    cpc_lists = [
+        sorted({code[:4] for code in cpc_codes.split(', ')}) if cpc_codes else []
+        for cpc_codes in patents["cpc_codes"]
+    ]
+
+    for publication_number, text_to_embed, cpc_list in zip(publication_numbers, texts_to_embed, cpc_lists):
+        id_prefix = f"{publication_number}-chunk-"
+
+        # Fast path: most patents already fit in a single chunk, so skip the splitter
+        if len(text_to_embed) <= CHUNK_SIZE:
+            ids.append(id_prefix + "0")
+            texts.append(text_to_embed.strip())
+            patent_ids.append(publication_number)
+            cpc_lists_by_chunk.append(cpc_list)
+            continue
 
+        chunks = text_splitter.split_text(text_to_embed)
+        ids.extend(id_prefix + str(j) for j in range(len(chunks)))
+        texts.extend(chunks)
+        patent_ids.extend([publication_number] * len(chunks))
+        cpc_lists_by_chunk.extend([cpc_list] * len(chunks))
+
+    return ids, texts, patent_ids, cpc_lists_by_chunk
+
+
+def build_embedded_window(ids, texts, patent_ids, cpc_lists, keys, embeddings, compressor=None):
+    """
+    Packs an embedded window as parallel columns (struct-of-arrays), dropping chunks
+    whose embedding failed ('None').
+
+    The embeddings become a single float32 matrix (Pinecone stores float32 anyway),
+    which is several times smaller than the per-chunk lists of Python floats while
+    the window waits in the upsert queue. With a compressor, the chunk text is stored
+    zstd-compressed as 'text_zstd' instead of 'text' (see src/backend/compression.py).
+
+    Returns:
+        dict: Columns 'ids', 'patent_ids', 'cpc_lists', 'texts', 'keys' (lists) and
+        'values' (an N x dimension matrix), plus 'text_field' (the metadata key for 'texts').
+    """
+    embedded = [i for i, values in enumerate(embeddings) if values is not None]
+    if len(embedded) < len(ids):
+        ids, texts, patent_ids, cpc_lists, keys = (
+            [column[i] for i in embedded] for column in (ids, texts, patent_ids, cpc_lists, keys)
+        )
+    if compressor is not None:
+        texts = [compression.compress_text(compressor, text) for text in texts]
+
+    return {
+        "ids": ids,
+        "patent_ids": patent_ids,
+        "cpc_lists": cpc_lists,
+        "texts": texts,
+        "text_field": "text" if compressor is None else "text_zstd",
+        "keys": keys,
+        "values": np.array([embeddings[i] for i in embedded], dtype=np.float32)
+    }
+
+
+def build_vector_batch(window, start, end):
+    """
+    Builds the Pinecone vector dicts for rows [start, end) of an embedded window.
+    Only one upsert batch of dicts exists at a time, not the whole window.
+    """
+    text_field = window["text_field"]
+    return [
+        {
+            "id": window["ids"][i],
+            "values": window["values"][i].tolist(),
+            "metadata": {
+                "patent_id": window["patent_ids"][i],
+                "cpc_codes": window["cpc_lists"][i],  # Store as a list for filtering
+                text_field: window["texts"][i]
+            }
+        }
+        for i in range(start, end)
+    ]
+
+
+def prepare_text_compressor(chunked_windows):
+    """
+    Returns a zstd compressor for chunk text, or None if ZSTD_DICT_PATH isn't set.
+
+    The dictionary at ZSTD_DICT_PATH is reused if it exists. Otherwise it is trained
+    on the chunk text of the first windows (about ZSTD_SAMPLE_BYTES) and saved there;
+    the app needs the same file to decompress query results.
+
+    Returns:
+        tuple: (compressor or None, chunked windows, including any that were sampled)
+    """
+    if not config.ZSTD_DICT_PATH:
+        return None, chunked_windows
+
+    dictionary = compression.load_dictionary(config.ZSTD_DICT_PATH)
+    if dictionary is not None:
+        print(f"  Compressing chunk text with the dictionary at {config.ZSTD_DICT_PATH}.")
+        return compression.make_compressor(dictionary), chunked_windows
+
+    # Sample the first windows, then put them back in front of the rest
+    sampled_windows, samples, sample_bytes = [], [], 0
+    for chunked_window in chunked_windows:
+        sampled_windows.append(chunked_window)
+        _, (_, texts, _, _) = chunked_window
+        samples.extend(text.encode("utf-8") for text in texts)
+        sample_bytes += sum(len(text) for text in texts)
+        if sample_bytes >= ZSTD_SAMPLE_BYTES:
+            break
+    chunked_windows = itertools.chain(sampled_windows, chunked_windows)
 
-def process_and_upsert(patents, index, embeddings, text_splitter):
-    """Takes the raw patent data and handles batch embedding and upserting."""
-
-    # Clear the index *before* adding new data
-    # We do this here, after we know the query worked.
-    print("  Clearing all old data from Pinecone index...")
     try:
-        index.delete(delete_all=True)
-        print("  Pinecone index cleared.")
+        dictionary = compression.train_dictionary(samples)
+        compression.save_dictionary(dictionary, config.ZSTD_DICT_PATH)
     except Exception as e:
-        # This can fail on a brand new index, which is fine.
-        print(f"  Info: Could not clear index (this is normal for a new index): {e}")
+        print(f"  Error training zstd dictionary. Storing uncompressed text. Error: {e}")
+        return None, chunked_windows
+
+    print(f"  Trained zstd dictionary on {len(samples)} chunks, saved to {config.ZSTD_DICT_PATH}.")
+    return compression.make_compressor(dictionary), chunked_windows
+
+
+def _init_chunk_worker(text_splitter):
+    """Stores the text splitter in a chunking worker process (sent once per process, not per window)."""
+    global _worker_text_splitter
+    _worker_text_splitter = text_splitter
+
+
+def _chunk_window(patents):
+    """Runs `chunk_patents()` inside a chunking worker process."""
+    return chunk_patents(patents, _worker_text_splitter)
+
+
+def chunk_windows(chunk_pool, patent_windows):
+    """
+    Chunks patent windows in worker processes, yielding the results in order.
+
+    Splitting text is pure-Python CPU work, so it runs in a process pool (threads
+    would serialize on the GIL). Each window is cut into CHUNK_WORKERS slices that
+    are chunked in parallel, and the next window is chunked while the current one
+    is being embedded.
+
+    Yields:
+        tuple: (number of patents in the window, (ids, texts, patent_ids, cpc_lists))
+    """
+    pending = None
+    for window in patent_windows:
+        window_size = len(window["publication_number"])
+        slice_size = -(-window_size // CHUNK_WORKERS)  # Ceiling division
+        futures = [
+            chunk_pool.submit(_chunk_window, {name: values[i: i + slice_size] for name, values in window.items()})
+            for i in range(0, window_size, slice_size)
+        ]
+        if pending is not None:
+            yield _gather_chunks(*pending)
+        pending = (window_size, futures)
+    if pending is not None:
+        yield _gather_chunks(*pending)
+
+
+def _gather_chunks(window_size, futures):
+    """Concatenates the chunk columns of a window's slices, in order."""
+    ids, texts, patent_ids, cpc_lists = [], [], [], []
+    for future in futures:
+        slice_ids, slice_texts, slice_patent_ids, slice_cpc_lists = future.result()
+        ids.extend(slice_ids)
+        texts.extend(slice_texts)
+        patent_ids.extend(slice_patent_ids)
+        cpc_lists.extend(slice_cpc_lists)
+    return window_size, (ids, texts, patent_ids, cpc_lists)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: up to `capacity` units can be taken at once, and
+    units refill continuously at `rate` per second. `acquire()` only sleeps when
+    the bucket doesn't hold enough units.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """Takes `amount` units (at most `capacity`), waiting until they're available."""
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def create_embedding_rate_limits():
+    """
+    Returns the (requests, tokens) buckets that pace embedding requests
+    to OPENAI_REQUESTS_PER_MINUTE and OPENAI_TOKENS_PER_MINUTE.
+    """
+    request_bucket = TokenBucket(OPENAI_REQUESTS_PER_MINUTE / 60, OPENAI_REQUEST_BURST)
+    token_bucket = TokenBucket(OPENAI_TOKENS_PER_MINUTE / 60, OPENAI_TOKENS_PER_MINUTE)
+    return request_bucket, token_bucket
+
+
+def embed_batch(embeddings, texts, rate_limits):
+    """Embeds one batch of texts once the rate limits allow it."""
+    request_bucket, token_bucket = rate_limits
+    request_bucket.acquire(1)
+    token_bucket.acquire(sum(len(text) for text in texts) // CHARS_PER_TOKEN + len(texts))
+    return embeddings.embed_documents(texts)
+
+
+def embed_chunks(executor, embeddings, texts, rate_limits):
+    """
+    Embeds texts in EMBED_BATCH_SIZE batches, running several batches at once.
+
+    Identical texts (boilerplate abstracts, overlapping chunks) are embedded only
+    once: each distinct text is keyed by its BLAKE2b digest and its embedding is
+    fanned back out to every position it appeared in.
+
+    Embedding is network-bound, so batches run in parallel on the executor. Results
+    are written back by position, so the order matches `texts` regardless of which
+    batch finishes first. Batches are paced by the `rate_limits` token buckets (see
+    `create_embedding_rate_limits()`), so they only wait when the per-minute budget is
+    spent; any 429s that still happen are retried with exponential backoff by the
+    OpenAI client itself (see OPENAI_MAX_RETRIES).
+
+    Returns:
+        list: One embedding per text ('None' for texts in batches that failed).
+    """
+    unique_index = {}  # chunk hash -> position in unique_texts
+    unique_texts = []
+    positions = []
+    for text in texts:
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        if key not in unique_index:
+            unique_index[key] = len(unique_texts)
+            unique_texts.append(text)
+        positions.append(unique_index[key])
+
+    unique_embeddings = [None] * len(unique_texts)
+    futures = {
+        executor.submit(embed_batch, embeddings, unique_texts[i: i + EMBED_BATCH_SIZE], rate_limits): i
+        for i in range(0, len(unique_texts), EMBED_BATCH_SIZE)
+    }
+    for future in as_completed(futures):
+        i = futures[future]
+        try:
+            batch_embeddings = future.result()
+            unique_embeddings[i: i + len(batch_embeddings)] = batch_embeddings
+        except Exception as e:
+            print(f"  Error embedding batch {i}. Skipping. Error: {e}")
 
-    print("Starting embedding and upserting process...")
-    all_chunks_to_embed = []
-    all_vectors_to_upsert = []
+    return [unique_embeddings[j] for j in positions]
 
-    print("Step 1/3: Chunking documents...")
-    for patent in tqdm(patents, desc="Chunking patents"):
-        # Handle potential None values from BigQuery
-        title = patent.title or ""
-        abstract = patent.abstract or ""
 
-        text_to_embed = f"Title: {title}\nAbstract: {abstract}"
-        chunks = text_splitter.split_text(text_to_embed)
+def chunk_key(vector_id, cpc_list, text):
+    """
+    Returns the checkpoint key of a chunk: its vector id ('{patent}-chunk-{j}') plus a
+    hash of its text and the patent's CPC codes.
+
+    A chunk is only skipped when the same content already sits at the same id, so
+    edited chunks are embedded again, and so are unchanged chunks that moved to a
+    new position when their patent was re-chunked.
+    """
+    digest = hashlib.blake2b(f"{text}\0{','.join(cpc_list)}".encode(), digest_size=8).hexdigest()
+    return f"{vector_id}:{digest}"
+
 
-        # This is critical: split the comma-separated string back into a list
-        cpc_list = patent.cpc_codes.split(', ') if patent.cpc_codes else []
-
-        for j, chunk in enumerate(chunks):
-            all_chunks_to_embed.append(chunk)
-            all_vectors_to_upsert.append({
-                "id": f"{patent.publication_number}-chunk-{j}",
-                "metadata": {
-                    "patent_id": patent.publication_number,
-                    "cpc_codes": cpc_list,  # Store as a list for filtering
-                    "text": chunk
-                }
-            })
-
-    print(f"  Total chunks to process: {len(all_chunks_to_embed)}")
-
-    print("Step 2/3: Batch embedding... (This will take a while)")
-    all_embeddings = []
-    for i in tqdm(range(0, len(all_chunks_to_embed), EMBED_BATCH_SIZE), desc="Embedding batches"):
-        batch_chunks = all_chunks_to_embed[i: i + EMBED_BATCH_SIZE]
+def load_checkpoint(path):
+    """
+    Reads the checkpoint file written by previous runs.
+
+    Returns:
+        tuple: (set of chunk keys already upserted, dict of patent id -> its last
+        recorded chunk count); both empty if there is no checkpoint yet.
+    """
+    embedded_keys, chunk_counts = set(), {}
+    try:
+        with open(path) as f:
+            for line in f.read().splitlines():
+                patent_id, separator, count = line.rpartition(CHECKPOINT_COUNT_SEPARATOR)
+                if separator:
+                    chunk_counts[patent_id] = int(count)  # Later lines override earlier ones
+                elif line:
+                    embedded_keys.add(line)
+    except FileNotFoundError:
+        pass
+    return embedded_keys, chunk_counts
+
+
+def find_stale_chunks(patent_ids, chunk_counts):
+    """
+    Compares each patent's chunk count in a window with the one recorded by previous runs.
+
+    A patent that now has fewer chunks leaves its old trailing `{patent}-chunk-{n}`
+    vectors behind in the index; upserting the new chunks doesn't overwrite them.
+
+    Args:
+        patent_ids (list): The window's per-chunk patent ids (before skipping unchanged chunks).
+        chunk_counts (dict): Patent id -> chunk count recorded by previous runs.
+
+    Returns:
+        tuple: (dict of patent id -> new chunk count, for patents whose count changed,
+        dict of patent id -> ids of its surplus chunk vectors, for patents that shrank)
+    """
+    changed_counts, stale_ids = {}, {}
+    for patent_id, count in Counter(patent_ids).items():
+        previous_count = chunk_counts.get(patent_id)
+        if previous_count == count:
+            continue
+        changed_counts[patent_id] = count
+        if previous_count is not None and previous_count > count:
+            stale_ids[patent_id] = [f"{patent_id}-chunk-{n}" for n in range(count, previous_count)]
+    return changed_counts, stale_ids
+
+
+def upsert_batch_size(dimension):
+    """
+    Returns the largest upsert batch that fits Pinecone's request limits.
+    Each vector costs 4 bytes per dimension plus its id and metadata.
+    """
+    bytes_per_vector = dimension * 4 + PINECONE_AVG_METADATA_BYTES
+    return max(1, min(PINECONE_MAX_BATCH_SIZE, PINECONE_MAX_REQUEST_BYTES // bytes_per_vector))
+
+
+def upsert_vectors(index, window, batch_size):
+    """
+    Upserts an embedded window (see `build_embedded_window()`) to Pinecone in
+    batches of batch_size.
+
+    Fires all upserts without waiting (async_req returns a gRPC future), then
+    waits for them, so the requests are multiplexed instead of sent one by one.
+
+    Returns:
+        list: The checkpoint keys of the vectors that were successfully upserted.
+    """
+    total = len(window["ids"])
+    pending_upserts = []
+    for i in range(0, total, batch_size):
+        end = min(i + batch_size, total)
         try:
-            batch_embeddings = embeddings.embed_documents(batch_chunks)
-            all_embeddings.extend(batch_embeddings)
+            batch_vectors = build_vector_batch(window, i, end)
+            pending_upserts.append((i, end, index.upsert(vectors=batch_vectors, async_req=True)))
         except Exception as e:
-            print(f"  Error embedding batch {i}. Skipping. Error: {e}")
-            # Add 'None' placeholders to keep lists in sync
-            all_embeddings.extend([None] * len(batch_chunks))
-        time.sleep(0.5)  # Avoid API rate limiting
-
-    # Add embeddings to our vector objects, filtering out failed ones
-    final_vectors_to_upsert = []
-    for i, vec_data in enumerate(all_vectors_to_upsert):
-        if all_embeddings[i] is not None:
-            vec_data["values"] = all_embeddings[i]
-            final_vectors_to_upsert.append(vec_data)
-
-    print(f"  Successfully embedded {len(final_vectors_to_upsert)} chunks.")
-
-    print("Step 3/3: Batch upserting to Pinecone...")
-    for i in tqdm(range(0, len(final_vectors_to_upsert), PINECONE_BATCH_SIZE), desc="Upserting batches"):
-        batch_vectors = final_vectors_to_upsert[i: i + PINECONE_BATCH_SIZE]
+            print(f"  Error upserting batch {i}. Skipping. Error: {e}")
+
+    upserted_keys = []
+    for i, end, upsert_future in pending_upserts:
         try:
-            index.upsert(vectors=batch_vectors)
+            upsert_future.result()
+            upserted_keys.extend(window["keys"][i: end])
         except Exception as e:
             print(f"  Error upserting batch {i}. Skipping. Error: {e}")
+    return upserted_keys
+
+
+def delete_stale_chunks(index, stale_ids):
+    """
+    Deletes the surplus chunk vectors found by `find_stale_chunks()`, in batches
+    of up to PINECONE_MAX_BATCH_SIZE ids.
+
+    Returns:
+        set: The patent ids whose surplus vectors could not be deleted.
+    """
+    # (patent id, vector id) pairs, so a failed batch can be traced back to its patents
+    stale_vectors = [(patent_id, vector_id) for patent_id, ids in stale_ids.items() for vector_id in ids]
+    failed_patents = set()
+    for i in range(0, len(stale_vectors), PINECONE_MAX_BATCH_SIZE):
+        batch = stale_vectors[i: i + PINECONE_MAX_BATCH_SIZE]
+        try:
+            index.delete(ids=[vector_id for _, vector_id in batch])
+        except Exception as e:
+            print(f"  Error deleting surplus chunks batch {i}. Skipping. Error: {e}")
+            failed_patents.update(patent_id for patent_id, _ in batch)
+    return failed_patents
 
+
+def upsert_worker(index, upsert_queue, batch_size, totals, checkpoint):
+    """
+    Consumer thread: upserts embedded windows from the queue until it receives None.
+    Runs alongside the embedding stage, so Pinecone and OpenAI requests overlap.
+
+    Surplus vectors of patents that now have fewer chunks are deleted first. The keys
+    of successfully upserted vectors and the patents' new chunk counts are appended
+    to the checkpoint file right away, so an interrupted run resumes where it stopped
+    (a count whose surplus vectors couldn't be deleted isn't recorded, so the next
+    run tries again).
+
+    An unexpected error (e.g., the checkpoint file can't be written) stops the
+    thread and is stored in totals["error"], so the producer can abort.
+    """
+    try:
+        while (window := upsert_queue.get()) is not None:
+            failed_patents = delete_stale_chunks(index, window["stale_ids"])
+            totals["deleted"] += sum(
+                len(ids) for patent_id, ids in window["stale_ids"].items() if patent_id not in failed_patents
+            )
+            upserted_keys = upsert_vectors(index, window, batch_size) if window["ids"] else []
+            totals["upserted"] += len(upserted_keys)
+            lines = upserted_keys + [
+                f"{patent_id}{CHECKPOINT_COUNT_SEPARATOR}{count}"
+                for patent_id, count in window["chunk_counts"].items() if patent_id not in failed_patents
+            ]
+            if lines:
+                checkpoint.write("\n".join(lines) + "\n")
+                checkpoint.flush()
+    except Exception as e:
+        print(f"  Error in upsert thread. Stopping ingestion. Error: {e}")
+        totals["error"] = e
+
+
+def put_while_alive(upsert_queue, item, upsert_thread):
+    """
+    Puts an item on the bounded upsert queue, waiting only while the consumer
+    thread is alive (a dead consumer would otherwise block the producer forever).
+
+    Returns:
+        bool: True if the item was queued, False if the consumer has stopped.
+    """
+    while upsert_thread.is_alive():
+        try:
+            upsert_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def process_and_upsert(patent_windows, total_patents, index, embeddings, text_splitter, fresh=False):
+    """
+    Takes the streamed patent windows and handles chunking, batch embedding and upserting.
+
+    Patents are processed in windows of up to INGEST_WINDOW_SIZE, so only one window
+    of chunks and vectors is held in memory at a time (not the whole result set).
+
+    Chunks recorded in the checkpoint file (CHECKPOINT_PATH) by earlier runs are
+    skipped, so re-running only embeds new or changed chunks, and the surplus vectors
+    of patents that now have fewer chunks are deleted. With fresh=True the index and
+    the checkpoint are cleared first and everything is ingested again.
+
+    Returns:
+        bool: False if ingestion was aborted before starting (the checkpoint doesn't match the index).
+    """
+    index_stats = index.describe_index_stats()
+
+    if fresh:
+        # Clear the index *before* adding new data
+        # We do this here, after we know the query worked.
+        print("  Clearing all old data from Pinecone index...")
+        try:
+            index.delete(delete_all=True)
+            print("  Pinecone index cleared.")
+        except Exception as e:
+            # This can fail on a brand new index, which is fine.
+            print(f"  Info: Could not clear index (this is normal for a new index): {e}")
+        embedded_keys, chunk_counts = set(), {}
+    else:
+        embedded_keys, chunk_counts = load_checkpoint(CHECKPOINT_PATH)
+        if embedded_keys and not index_stats.total_vector_count:
+            # Everything would be skipped, leaving the index empty (e.g., it was
+            # recreated or cleared since the checkpoint was written)
+            print(f"  ---!! FATAL ERROR !! ---")
+            print(f"  The index is empty, but {CHECKPOINT_PATH} lists {len(embedded_keys)} ingested chunks.")
+            print(f"  Run again with --fresh to clear the checkpoint and ingest everything.")
+            return False
+        print(f"  Found {len(embedded_keys)} already-ingested chunks in {CHECKPOINT_PATH}; they will be skipped.")
+
+    batch_size = upsert_batch_size(index_stats.dimension)
+    print(f"  Upserting in batches of {batch_size} vectors.")
+
+    print("Starting chunking, embedding and upserting (This will take a while)...")
+    total_chunks = 0
+    skipped_chunks = 0
+
+    # Embedding (producer, this thread) and upserting (consumer thread) run concurrently,
+    # connected by a bounded queue of embedded windows
+    checkpoint = open(CHECKPOINT_PATH, "w" if fresh else "a")
+    upsert_queue = queue.Queue(maxsize=UPSERT_QUEUE_SIZE)
+    totals = {"upserted": 0, "deleted": 0, "error": None}
+    upsert_thread = threading.Thread(
+        target=upsert_worker, args=(index, upsert_queue, batch_size, totals, checkpoint)
+    )
+    upsert_thread.start()
+
+    rate_limits = create_embedding_rate_limits()
+
+    try:
+        # Workers are spawned, not forked: by now this process has live gRPC channels
+        # (Pinecone, BigQuery Storage) and threads, which aren't safe to fork
+        with ProcessPoolExecutor(max_workers=CHUNK_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_chunk_worker, initargs=(text_splitter,)) as chunk_pool, \
+                ThreadPoolExecutor(max_workers=EMBED_WORKERS) as executor, \
+                tqdm(total=total_patents, desc="Ingesting patents") as progress:
+            # Step 1/3: Chunking (in worker processes, ahead of the embedding stage)
+            chunked_windows = chunk_windows(chunk_pool, patent_windows)
+            compressor, chunked_windows = prepare_text_compressor(chunked_windows)
+            for window_size, (ids, texts, patent_ids, cpc_lists) in chunked_windows:
+                progress.update(window_size)
+
+                # Skip chunks that previous runs already upserted unchanged, and find the
+                # surplus vectors of patents that now have fewer chunks
+                changed_counts, stale_ids = find_stale_chunks(patent_ids, chunk_counts)
+                keys = [chunk_key(i, c, t) for i, c, t in zip(ids, cpc_lists, texts)]
+                keep = [i for i, key in enumerate(keys) if key not in embedded_keys]
+                skipped_chunks += len(keys) - len(keep)
+                if not keep and not changed_counts:
+                    continue
+                if len(keep) < len(keys):
+                    ids, texts, patent_ids, cpc_lists, keys = (
+                        [column[i] for i in keep] for column in (ids, texts, patent_ids, cpc_lists, keys)
+                    )
+
+                # Step 2/3: Batch embedding (filtering out failed chunks)
+                window_embeddings = embed_chunks(executor, embeddings, texts, rate_limits) if texts else []
+                window = build_embedded_window(
+                    ids, texts, patent_ids, cpc_lists, keys, window_embeddings, compressor
+                )
+                window["chunk_counts"] = changed_counts
+                window["stale_ids"] = stale_ids
+
+                # Step 3/3: Hand off for upserting (blocks if upserting falls behind)
+                total_chunks += len(ids)
+                if not put_while_alive(upsert_queue, window, upsert_thread):
+                    raise RuntimeError(f"Upsert thread stopped unexpectedly: {totals['error']}")
+    finally:
+        # Let the consumer drain the queue, then stop
+        put_while_alive(upsert_queue, None, upsert_thread)
+        upsert_thread.join()
+        checkpoint.close()
+
+    if totals["error"] is not None:
+        raise RuntimeError(f"Upsert thread stopped unexpectedly: {totals['error']}")
+
+    if skipped_chunks:
+        print(f"  Skipped {skipped_chunks} unchanged chunks from previous runs.")
+    if totals["deleted"]:
+        print(f"  Deleted {totals['deleted']} surplus chunks of patents that now have fewer chunks.")
+    print(f"  Successfully embedded and upserted {totals['upserted']} of {total_chunks} chunks.")
     print("--- Upsert Complete ---")
+    return True
+
+
+def parse_args():
+    """Parses the command-line options."""
+    parser = argparse.ArgumentParser(description="Ingest patents from BigQuery into the Pinecone index.")
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="Clear the Pinecone index and the checkpoint file, then ingest everything again."
+    )
+    return parser.parse_args()
 
 
 def main():
     """Main function to run the full ingestion pipeline."""
-    bq_client, index, embeddings, text_splitter = initialize_clients()
-    if not all([bq_client, index, embeddings, text_splitter]):
+    args = parse_args()
+
+    bq_client, bqstorage_client, index, embeddings, text_splitter = initialize_clients()
+    if not all([bq_client, bqstorage_client, index, embeddings, text_splitter]):
         print("Exiting due to initialization failure.")
         return
 
     print(f"--- Running Query to fetch ({BIGQUERY_SQL_QUERY.split('LIMIT')[-1].strip().replace(';', '')} patents) ---")
     patents = fetch_data_from_bigquery(bq_client, BIGQUERY_SQL_QUERY)
 
-    if not patents:
+    if patents is None or not patents.total_rows:
         print("Test query failed to fetch patents. Exiting.")
         return
 
-    process_and_upsert(patents, index, embeddings, text_splitter)
+    patent_windows = iter_patent_windows(patents, bqstorage_client)
+    if not process_and_upsert(patent_windows, patents.total_rows, index, embeddings, text_splitter,
+                              fresh=args.fresh):
+        print("Exiting without ingesting.")
+        return
 
     print("\n--- Ingestion Pipeline Finished ---")
     print("Final Pinecone index stats after test:")
@@ -1,64 +1,245 @@
+import hashlib
 import json
+import os
+import tempfile
+
+import streamlit as st
+from langchain_core.exceptions import OutputParserException
+from pydantic import BaseModel, Field, ValidationError
+
 from . import llm_client, prompts, retrieval
 
+# Fingerprint of the prompt templates. It's part of the analysis cache key,
+# so editing a prompt invalidates previously cached reports.
+_PROMPT_VERSION = hashlib.sha256(
+    (prompts.QUERY_TRANSFORMATION_PROMPT + prompts.ANALYST_SYNTHESIS_PROMPT).encode()
+).hexdigest()[:16]
+
+# Fingerprint of the query transformation prompt alone, for the on-disk HyDE cache
+_QT_PROMPT_VERSION = hashlib.sha256(prompts.QUERY_TRANSFORMATION_PROMPT.encode()).hexdigest()[:16]
+
+# On-disk HyDE cache: one JSON file per (description, prompt version), oldest pruned first
+QT_CACHE_DIR = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", ".cache", "query_transformation")
+)
+QT_CACHE_MAX_ENTRIES = 256
+
+
+# --- Structured output schema for Stage 1 ---
+class SearchBlock(BaseModel):
+    """Search artifacts for one part of the invention."""
+    technical_keywords: list[str] = Field(description="5-7 specific technical keywords and synonyms.")
+    hyde_abstract: str = Field(min_length=1, description="A hypothetical patent abstract for this part of the invention.")
+    cpc_codes: list[str] = Field(min_length=1, description="The 3-5 most likely 4-character CPC subclasses (e.g., 'G06N').")
+
+
+class SearchArtifacts(BaseModel):
+    """The two sets of search artifacts produced by the query transformation."""
+    base_technology_search: SearchBlock
+    novel_features_search: SearchBlock
+
+
+class _AnalysisFailed(Exception):
+    """Raised inside the cached analysis so that error results are never cached."""
+
+    def __init__(self, result):
+        super().__init__(result["error"])
+        self.result = result
+
+
+class _IncompleteSearchArtifacts(ValueError):
+    """Raised when the LLM doesn't return a valid search plan."""
+
+
+def normalize_description(user_description: str) -> str:
+    """Lowercases and collapses whitespace so trivially different descriptions share a cache entry."""
+    return " ".join(user_description.lower().split())
+
 
-def run_analysis(user_description: str):
+def _qt_cache_path(desc_norm, prompt_version):
+    """Returns the on-disk cache file for a normalized description and prompt version."""
+    digest = hashlib.sha256(f"{prompt_version}\0{desc_norm}".encode()).hexdigest()[:32]
+    return os.path.join(QT_CACHE_DIR, f"{digest}.json")
+
+
+def _load_cached_search_artifacts(path):
+    """
+    Reads search artifacts from the on-disk cache.
+
+    Returns:
+        dict: The cached artifacts, or None on a miss (or an unreadable file).
+    """
+    try:
+        with open(path) as f:
+            search_artifacts = json.load(f)
+        os.utime(path)  # Mark as recently used, so pruning keeps it
+        return search_artifacts
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Warning: Could not read query transformation cache file {path}: {e}")
+        return None
+
+
+def _save_cached_search_artifacts(path, search_artifacts):
+    """
+    Writes search artifacts to the on-disk cache, then deletes the least recently
+    used files beyond QT_CACHE_MAX_ENTRIES. Failures only cost a future cache hit.
+    """
+    try:
+        os.makedirs(QT_CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=QT_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(search_artifacts, f)
+        os.replace(tmp_path, path)
+
+        entries = [entry for entry in os.scandir(QT_CACHE_DIR) if entry.name.endswith(".json")]
+        if len(entries) > QT_CACHE_MAX_ENTRIES:
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:len(entries) - QT_CACHE_MAX_ENTRIES]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass  # Already pruned by another session
+    except OSError as e:
+        print(f"Warning: Could not write query transformation cache file {path}: {e}")
+
+
+@st.cache_data(max_entries=QT_CACHE_MAX_ENTRIES, show_spinner=False)
+def _cached_query_transformation(desc_norm, prompt_version, _llm, _user_description):
+    """
+    Stage 1 (Query Transformation): asks the LLM for the base + novel search artifacts.
+
+    Cached in memory and in QT_CACHE_DIR, keyed on the normalized description and
+    prompt version, so the same idea reuses its HyDE abstracts across sessions and
+    app restarts. Both caches keep at most QT_CACHE_MAX_ENTRIES entries (the least
+    recently used files are deleted). Invalid or incomplete responses raise, so they
+    are never cached.
+
+    The LLM is bound to the `SearchArtifacts` schema, so it returns validated
+    fields directly instead of free text that has to be parsed.
+    """
+    cache_path = _qt_cache_path(desc_norm, prompt_version)
+    search_artifacts = _load_cached_search_artifacts(cache_path)
+    if search_artifacts is not None:
+        return search_artifacts
+
+    qt_prompt_formatted = prompts.QUERY_TRANSFORMATION_PROMPT.format(
+        user_description=_user_description
+    )
+
+    structured_llm = _llm.with_structured_output(SearchArtifacts)
+    try:
+        search_artifacts = structured_llm.invoke(qt_prompt_formatted)
+    except (OutputParserException, ValidationError) as e:
+        print(f"Error: LLM response did not match the search artifacts schema: {e}")
+        raise _IncompleteSearchArtifacts(str(e)) from e
+
+    if search_artifacts is None:
+        raise _IncompleteSearchArtifacts("empty response")
+
+    search_artifacts = search_artifacts.model_dump()
+    _save_cached_search_artifacts(cache_path, search_artifacts)
+    return search_artifacts
+
+
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def _cached_run_analysis(desc_norm, prompt_version, _user_description, _on_search_artifacts, _cache_misses):
+    """
+    Cached body of `cached_run_analysis`. Only the normalized description and the
+    prompt version form the cache key (underscore arguments are not hashed).
+    """
+    _cache_misses.append(desc_norm)
+    result = run_analysis(_user_description, on_search_artifacts=_on_search_artifacts)
+    if "error" in result:
+        raise _AnalysisFailed(result)
+    return result
+
+
+def cached_run_analysis(user_description: str, on_search_artifacts=None):
+    """
+    Runs `run_analysis`, reusing the result of an identical (normalized) description
+    analyzed within the last hour. Failed analyses are not cached.
+
+    Returns:
+        tuple: (analysis result dict, True if the result came from the cache)
+    """
+    cache_misses = []
+    try:
+        result = _cached_run_analysis(
+            normalize_description(user_description),
+            _PROMPT_VERSION,
+            user_description,
+            on_search_artifacts,
+            cache_misses
+        )
+    except _AnalysisFailed as e:
+        return e.result, False
+
+    cache_hit = not cache_misses
+    if cache_hit:
+        print("--- Analysis served from cache ---")
+    return result, cache_hit
+
+
+def run_analysis(user_description: str, on_search_artifacts=None):
     """
     Executes the full Patent Analyst Agent pipeline using a
     multi-query retrieval strategy.
 
     1. Query Transformation (Broad + Novel)
-    2. Advanced Hybrid Retrieval (Run twice)
+    2. Advanced Hybrid Retrieval (Two queries, one batched embedding request)
     3. De-duplication and Combining
     4. Analyst Synthesis
+
+    Args:
+        user_description (str): The user's invention description.
+        on_search_artifacts (callable, optional): Called with the search artifacts
+            as soon as Stage 1 finishes, so callers can show them before the
+            (slower) retrieval and synthesis stages complete.
     """
     print("--- 1. Starting Query Transformation ---")
 
     llm = llm_client.get_llm()
     if llm is None:
         return {
-            "Error": "Could not initialize LLM. Check API keys and config."
+            "error": "Could not initialize LLM. Check API keys and config."
         }
 
     # --- Stage 1: Query Transformation ---
     search_artifacts = {}
     try:
-        qt_prompt_formatted = prompts.QUERY_TRANSFORMATION_PROMPT.format(
-            user_description=user_description
+        search_artifacts = _cached_query_transformation(
+            normalize_description(user_description),
+            _QT_PROMPT_VERSION,
+            llm,
+            user_description
         )
 
-        response = llm.invoke(qt_prompt_formatted)
-
-        response_content = response.content.strip()
-        if response_content.startswith("```json"):
-            response_content = response_content[7:-4].strip()
-
-        search_artifacts = json.loads(response_content)
-
         # Parse the two separate search query objects
-        base_search = search_artifacts.get("base_technology_search", {})
-        novel_search = search_artifacts.get("novel_features_search", {})
+        base_search = search_artifacts["base_technology_search"]
+        novel_search = search_artifacts["novel_features_search"]
 
-        base_hyde = base_search.get("hyde_abstract")
-        base_cpc = base_search.get("cpc_codes")
+        base_hyde = base_search["hyde_abstract"]
+        base_cpc = base_search["cpc_codes"]
 
-        novel_hyde = novel_search.get("hyde_abstract")
-        novel_cpc = novel_search.get("cpc_codes")
+        novel_hyde = novel_search["hyde_abstract"]
+        novel_cpc = novel_search["cpc_codes"]
 
         print(f"  Generated Base HyDE: {base_hyde[:50]}...")
         print(f"  Generated Base CPCs: {base_cpc}")
         print(f"  Generated Novel HyDE: {novel_hyde[:50]}...")
         print(f"  Generated Novel CPCs: {novel_cpc}")
 
-        if not (base_hyde and base_cpc and novel_hyde and novel_cpc):
-            return "Error: LLM failed to generate all required search artifacts."
-
-    except json.JSONDecodeError:
-        print(f"Error: Failed to decode LLM JSON response. Response was:\n{response.content}")
-        return "Error: Agent failed to parse LLM response during query transformation."
+    except _IncompleteSearchArtifacts:
+        return {"error": "Error: LLM failed to generate all required search artifacts."}
     except Exception as e:
         print(f"Error in Stage 1 (Query Transformation): {e}")
-        return "Error during query transformation."
+        return {"error": "Error during query transformation."}
+
+    if on_search_artifacts is not None:
+        on_search_artifacts(search_artifacts)
 
     # --- Stage 2: Advanced Hybrid Retrieval (Multi-Query) ---
     print("\n--- 2. Starting Advanced Hybrid Retrieval ---")
@@ -66,23 +247,16 @@ def run_analysis(user_description: str):
     all_contexts = {}  # Use a dict for easy de-duplication by patent_id
 
     try:
-        # Call 1: Broad search for base technology
-        print("  Running Base Technology Search...")
-        base_contexts = retrieval.fetch_relevant_patents(
-            hyde_abstract=base_hyde,
-            cpc_codes=base_cpc,
-            top_k=3  # Get 3 top results for broad search
-        )
+        # Both HyDE abstracts are embedded in one request, then the two
+        # Pinecone queries run in parallel
+        print("  Running Base Technology and Novel Features Searches...")
+        base_contexts, novel_contexts = retrieval.fetch_relevant_patents_multi([
+            (base_hyde, base_cpc, 3),  # Broad search for base technology (top 3)
+            (novel_hyde, novel_cpc, 3)  # Specific search for novel features (top 3)
+        ])
+
         for ctx in base_contexts:
             all_contexts[ctx['patent_id']] = ctx  # Add to dict
-
-        # Call 2: Specific search for novel features
-        print("  Running Novel Features Search...")
-        novel_contexts = retrieval.fetch_relevant_patents(
-            hyde_abstract=novel_hyde,
-            cpc_codes=novel_cpc,
-            top_k=3  # Get 3 top results for novel search
-        )
         for ctx in novel_contexts:
             all_contexts[ctx['patent_id']] = ctx  # Add/overwrite in dict
 
@@ -103,7 +277,7 @@ def run_analysis(user_description: str):
 
     except Exception as e:
         print(f"Error in Stage 2 (Retrieval): {e}")
-        return "Error during patent retrieval."
+        return {"error": "Error during patent retrieval."}
 
     # --- Stage 4: Analyst Synthesis ---
     print("\n--- 3. Starting Analyst Synthesis ---")
@@ -120,7 +294,7 @@ def run_analysis(user_description: str):
 
     except Exception as e:
         print(f"Error in Stage 3 (Synthesis): {e}")
-        return "Error during final report synthesis."
+        return {"error": "Error during final report synthesis."}
 
     print("\n--- Analysis Complete ---")
 
@@ -0,0 +1,71 @@
+"""
+Zstandard dictionary compression for chunk text stored in Pinecone metadata.
+
+Patent chunks are short and share a lot of boilerplate ("Title: ... Abstract: ...",
+claim-like phrasing), so compressing each one on its own gains little. A dictionary
+trained on a sample of chunks captures that shared vocabulary once, and every chunk
+is then compressed against it.
+
+The ingestion script trains (or loads) the dictionary and stores `text_zstd`
+(base64-encoded) instead of `text`; retrieval decompresses it with the same dictionary.
+"""
+
+import base64
+import binascii
+
+import zstandard as zstd
+
+ZSTD_DICT_SIZE = 100_000  # Bytes; the trained dictionary's size
+ZSTD_LEVEL = 9  # Compression level (ingestion only; decompression speed doesn't depend on it)
+
+# Raised by `decompress_text()` for corrupt data, bad base64, or the wrong dictionary
+DECOMPRESSION_ERRORS = (zstd.ZstdError, binascii.Error, UnicodeDecodeError)
+
+
+def train_dictionary(samples):
+    """
+    Trains a compression dictionary.
+
+    Args:
+        samples (list): Sample chunk texts, as bytes (a few MB gives a good dictionary).
+
+    Returns:
+        zstd.ZstdCompressionDict: The trained dictionary.
+    """
+    return zstd.train_dictionary(ZSTD_DICT_SIZE, samples)
+
+
+def load_dictionary(path):
+    """
+    Loads a dictionary saved with `save_dictionary()`.
+
+    Returns:
+        zstd.ZstdCompressionDict: The dictionary, or None if the file doesn't exist.
+    """
+    try:
+        with open(path, "rb") as f:
+            return zstd.ZstdCompressionDict(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def save_dictionary(dictionary, path):
+    """Writes a dictionary to disk, for retrieval (and later ingestion runs) to load."""
+    with open(path, "wb") as f:
+        f.write(dictionary.as_bytes())
+
+
+def make_compressor(dictionary):
+    """Returns a compressor bound to the dictionary (not thread-safe: use one per thread)."""
+    return zstd.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary)
+
+
+def compress_text(compressor, text):
+    """Compresses text and base64-encodes it, since Pinecone metadata values must be strings."""
+    return base64.b64encode(compressor.compress(text.encode("utf-8"))).decode("ascii")
+
+
+def decompress_text(dictionary, data):
+    """Reverses `compress_text()`."""
+    decompressor = zstd.ZstdDecompressor(dict_data=dictionary)
+    return decompressor.decompress(base64.b64decode(data)).decode("utf-8")
@@ -16,7 +16,19 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
 # Model Names
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
+# Output size for text-embedding-3-* models (shortened embeddings); must match the Pinecone index.
+# Unset = the model's full size (1536 for text-embedding-3-small).
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS")) if os.getenv("EMBEDDING_DIMENSIONS") else None
 LLM_MODEL = os.getenv("LLM_MODEL")
 
+# Zstd dictionary for compressed chunk text in Pinecone metadata (optional).
+# Written by the ingestion script; the app must be able to read the same file.
+ZSTD_DICT_PATH = os.getenv("ZSTD_DICT_PATH")
+
 # SerpAPI
 SERPAPI_API_KEY = os.getenv("SERPAPI_API_KEY")
+
+# Redis (optional, for rate limiting shared across app workers/replicas)
+REDIS_URL = os.getenv("REDIS_URL")
+# If Redis is unreachable: "true" = fall back to per-session limits, otherwise block queries (fail closed)
+RATE_LIMIT_SESSION_FALLBACK = os.getenv("RATE_LIMIT_SESSION_FALLBACK", "false").lower() in ("1", "true", "yes")
@@ -0,0 +1,97 @@
+"""
+Minimal streaming .docx writer.
+
+Builds a Word document straight into a zip archive, writing one paragraph of
+`word/document.xml` at a time instead of building a full python-docx object tree
+first. Memory use is proportional to a single line of the report, not the whole
+document.
+"""
+
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+# --- Fixed package parts ---
+_CONTENT_TYPES_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>
+</Types>"""
+
+_RELS_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+_DOCUMENT_RELS_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+_STYLES_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
+<w:docDefaults>
+<w:rPrDefault><w:rPr><w:rFonts w:ascii="Calibri" w:hAnsi="Calibri" w:eastAsia="Calibri" w:cs="Calibri"/><w:sz w:val="22"/></w:rPr></w:rPrDefault>
+<w:pPrDefault><w:pPr><w:spacing w:after="160" w:line="259" w:lineRule="auto"/></w:pPr></w:pPrDefault>
+</w:docDefaults>
+<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/><w:qFormat/></w:style>
+<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/><w:next w:val="Normal"/><w:qFormat/><w:pPr><w:spacing w:after="240"/></w:pPr><w:rPr><w:sz w:val="56"/></w:rPr></w:style>
+</w:styles>"""
+
+# --- word/document.xml pieces ---
+_DOCUMENT_PRELUDE = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>"""
+
+_DOCUMENT_POSTLUDE = """<w:sectPr><w:pgSz w:w="12240" w:h="15840"/><w:pgMar w:top="1440" w:right="1440" w:bottom="1440" w:left="1440" w:header="720" w:footer="720" w:gutter="0"/></w:sectPr></w:body></w:document>"""
+
+_TITLE_PARAGRAPH = '<w:p><w:pPr><w:pStyle w:val="Title"/></w:pPr><w:r><w:t xml:space="preserve">%s</w:t></w:r></w:p>'
+_PARAGRAPH = '<w:p><w:r><w:t xml:space="preserve">%s</w:t></w:r></w:p>'
+_EMPTY_PARAGRAPH_BYTES = b'<w:p/>'
+
+# Control characters that are not allowed in XML 1.0
+_INVALID_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _xml_text(text):
+    """Escapes text for use inside a <w:t> element."""
+    return escape(_INVALID_XML_CHARS.sub("", text))
+
+
+def build_docx(content: str, title: str) -> bytes:
+    """
+    Creates a .docx file with a title followed by one paragraph per line of content.
+    Consecutive blank lines are collapsed into a single empty paragraph.
+
+    Args:
+        content (str): The report text.
+        title (str): The document title (rendered with the 'Title' style).
+
+    Returns:
+        bytes: The .docx file contents.
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", _CONTENT_TYPES_XML)
+        zf.writestr("_rels/.rels", _RELS_XML)
+        zf.writestr("word/_rels/document.xml.rels", _DOCUMENT_RELS_XML)
+        zf.writestr("word/styles.xml", _STYLES_XML)
+
+        # Stream the document body paragraph by paragraph
+        with zf.open("word/document.xml", "w") as doc:
+            doc.write(_DOCUMENT_PRELUDE.encode("utf-8"))
+            doc.write((_TITLE_PARAGRAPH % _xml_text(title)).encode("utf-8"))
+            previous_blank = False
+            for line in content.split("\n"):
+                if line.strip():
+                    doc.write((_PARAGRAPH % _xml_text(line)).encode("utf-8"))
+                    previous_blank = False
+                elif not previous_blank:
+                    # Collapse runs of blank lines into a single empty paragraph
+                    doc.write(_EMPTY_PARAGRAPH_BYTES)
+                    previous_blank = True
+            doc.write(_DOCUMENT_POSTLUDE.encode("utf-8"))
+
+    return buffer.getvalue()
@@ -1,28 +1,67 @@
+import threading
+
+import httpx
 from langchain_groq import ChatGroq
 from langchain_openai import OpenAIEmbeddings
 
 from . import config
 
+# Connections kept open per API host, shared by every thread of the process
+HTTP_MAX_CONNECTIONS = 32
+
+# Shared clients, created on first use
+_http_client = None
+_llm = None
+_embedding_model = None
+_clients_lock = threading.Lock()
+
+
+def get_http_client():
+    """
+    Returns the process-wide pooled HTTP client used for the Groq and OpenAI APIs.
+
+    Reusing one client keeps connections alive between requests, so the TLS
+    handshake happens once per connection instead of once per call.
+    """
+    global _http_client
+    with _clients_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_CONNECTIONS
+                )
+            )
+        return _http_client
+
 
 def get_llm():
     """
     Initializes and returns the main Language Model (LLM) for reasoning.
 
     This function reads the model name and API key from the config
-    and returns an initialized LangChain model object.
+    and returns an initialized LangChain model object. The model is created
+    once and shared; if initialization fails, it is retried on the next call.
     """
+    global _llm
     if not config.GROQ_API_KEY:
         raise ValueError("GROQ_API_KEY not found in environment variables.")
+    if _llm is not None:
+        return _llm
     try:
         llm = ChatGroq(
             model=config.LLM_MODEL,
             api_key=config.GROQ_API_KEY,
-            temperature=0.0  # We want deterministic, analytical output
+            temperature=0.0,  # We want deterministic, analytical output
+            http_client=get_http_client()
         )
-        return llm
     except Exception as e:
         print(f"Error initializing Groq LLM: {e}")
         return None
+    with _clients_lock:
+        if _llm is None:
+            _llm = llm
+        return _llm
 
 
 def get_embedding_model():
@@ -30,17 +69,39 @@ def get_embedding_model():
     Initializes and returns the embedding model.
 
     This function reads the embedding model name and API key from the
-    config and returns an initialized LangChain embedding model object.
+    config and returns an initialized LangChain embedding model object. The
+    model is created once and shared; if initialization fails, it is retried
+    on the next call.
     """
+    global _embedding_model
     if not config.OPENAI_API_KEY:
         raise ValueError("OPENAI_API_KEY not found in environment variables.")
+    if _embedding_model is not None:
+        return _embedding_model
 
     try:
-        embedding_model = OpenAIEmbeddings(
-            model=config.EMBEDDING_MODEL,
-            openai_api_key=config.OPENAI_API_KEY
-        )
-        return embedding_model
+        embedding_model = create_embedding_model()
     except Exception as e:
         print(f"Error initializing Embedding Model: {e}")
         return None
+    with _clients_lock:
+        if _embedding_model is None:
+            _embedding_model = embedding_model
+        return _embedding_model
+
+
+def create_embedding_model(**kwargs):
+    """
+    Creates a new embedding model on the shared HTTP client.
+
+    Use `get_embedding_model()` unless you need different settings (e.g., the
+    ingestion script's higher retry count); extra keyword arguments are passed
+    to `OpenAIEmbeddings`.
+    """
+    return OpenAIEmbeddings(
+        model=config.EMBEDDING_MODEL,
+        openai_api_key=config.OPENAI_API_KEY,
+        dimensions=config.EMBEDDING_DIMENSIONS,
+        http_client=get_http_client(),
+        **kwargs
+    )
@@ -17,7 +17,8 @@ For each set, generate:
 -   **technical_keywords**: A list of 5-7 specific technical keywords and synonyms.
 -   **hyde_abstract**: A "hypothetical document" abstract for that
     specific part of the invention.
--   **cpc_codes**: The 3-5 most likely Cooperative Patent Classification (CPC) codes.
+-   **cpc_codes**: The 3-5 most likely Cooperative Patent Classification (CPC) subclasses,
+    as 4-character codes only (e.g., "G06N", not "G06N 3/08").
 
 **User's Invention Idea:**
 "{user_description}"
@@ -33,7 +34,7 @@ For each set, generate:
     "base_technology_search": {{
         "technical_keywords": ["...", "..."],
         "hyde_abstract": "...",
-        "cpc_codes": ["...", "..."]
+        "cpc_codes": ["G06N", "..."]
     }},
     "novel_features_search": {{
         "technical_keywords": ["...", "..."],
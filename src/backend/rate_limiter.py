@@ -2,18 +2,29 @@
 Simple rate limiting for Streamlit apps.
 
 This module provides lightweight rate limiting suitable for Streamlit Cloud (free tier).
-It uses session state to track usage per user session.
+It uses session state to track usage per user session with a token bucket, so users
+can burst up to the bucket capacity and then regain queries gradually over time.
+
+For deployments with several workers/replicas, `RedisRateLimiter` keeps the same
+token bucket in Redis, keyed on the hashed client IP address, so limits are shared globally
+and survive browser refreshes.
 """
 
+import hashlib
+import math
+import time
+
+import redis
 import streamlit as st
 
 
 class SimpleRateLimiter:
     """
-    A simple session-based rate limiter for Streamlit apps.
+    A simple session-based token-bucket rate limiter for Streamlit apps.
 
     Features:
-    - Per-session query limits (resets on browser refresh)
+    - Per-session token bucket (burst up to `capacity`, refills at `refill_rate`)
+    - Queries regenerate over time, no browser refresh needed
     - No external dependencies (pure session state)
     - Transparent about limitations
 
@@ -21,48 +32,81 @@ class SimpleRateLimiter:
     Not suitable for: Blocking malicious actors (can be bypassed by refreshing browser)
 
     Note: This provides "soft" rate limiting. Users can refresh the browser to get
-    a new session with a fresh query counter. For stronger protection, consider
+    a new session with a full bucket. For stronger protection, consider
     IP-based tracking (requires external database) or authentication.
     """
 
-    def __init__(self, max_queries_per_session=5):
+    def __init__(self, capacity=5, refill_rate=5 / 3600):
         """
         Initialize the rate limiter.
 
         Args:
-            max_queries_per_session (int): Maximum queries allowed per session
+            capacity (int): Maximum number of queries that can be made in a burst
+            refill_rate (float): Number of queries regained per second
+        """
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+
+        # Initialize session state if needed (a new session starts with a full bucket)
+        if 'rl_tokens' not in st.session_state:
+            st.session_state.rl_tokens = float(capacity)
+            st.session_state.rl_last_refill = time.monotonic()
+
+    def _refill(self):
         """
-        self.max_queries = max_queries_per_session
+        Add the tokens earned since the last refill and return the current balance.
 
-        # Initialize session state if needed
-        if 'query_count' not in st.session_state:
-            st.session_state.query_count = 0
+        Returns:
+            float: Number of tokens currently in the bucket
+        """
+        now = time.monotonic()
+        elapsed = now - st.session_state.rl_last_refill
+        st.session_state.rl_tokens = min(
+            self.capacity, st.session_state.rl_tokens + elapsed * self.refill_rate
+        )
+        st.session_state.rl_last_refill = now
+        return st.session_state.rl_tokens
 
     def can_query(self):
         """
-        Check if the user can make another query.
+        Check if the user can make another query and, if so, take a token for it.
+        Call `refund()` if the query ends up failing.
 
         Returns:
             bool: True if query is allowed, False if limit reached
         """
-        return st.session_state.query_count < self.max_queries
+        if self._refill() >= 1:
+            st.session_state.rl_tokens -= 1
+            return True
+        return False
 
-    def increment(self):
+    def refund(self):
         """
-        Increment the query counter.
-        Should be called after a successful query.
+        Give back the token taken by `can_query()`.
+        Should be called when a query fails, so errors don't count against the user.
         """
-        st.session_state.query_count += 1
+        st.session_state.rl_tokens = min(self.capacity, st.session_state.rl_tokens + 1)
 
     def get_remaining_queries(self):
         """
-        Get the number of queries remaining in this session.
+        Get the number of queries that can be made right now.
 
         Returns:
             int: Number of queries remaining
         """
-        remaining = self.max_queries - st.session_state.query_count
-        return max(0, remaining)
+        return math.floor(self._refill())
+
+    def get_seconds_until_next_query(self):
+        """
+        Get the time until the next query becomes available.
+
+        Returns:
+            int: Seconds to wait (0 if a query is available now)
+        """
+        tokens = self._refill()
+        if tokens >= 1:
+            return 0
+        return math.ceil((1 - tokens) / self.refill_rate)
 
     def get_usage_message(self):
         """
@@ -74,9 +118,10 @@ class SimpleRateLimiter:
         remaining = self.get_remaining_queries()
 
         if remaining > 0:
-            return f"✅ You have **{remaining}** of **{self.max_queries}** queries remaining in this session."
+            return f"✅ You have **{remaining}** of **{self.capacity}** queries remaining."
         else:
-            return f"❌ Session limit reached (**{self.max_queries}** queries used). Refresh the page to start a new session."
+            wait = _format_wait(self.get_seconds_until_next_query())
+            return f"❌ Query limit reached. Your next query will be available in about **{wait}**."
 
     def show_usage_indicator(self):
         """
@@ -84,10 +129,10 @@ class SimpleRateLimiter:
         Shows a progress bar and usage message.
         """
         remaining = self.get_remaining_queries()
-        used = self.max_queries - remaining
+        used = self.capacity - remaining
 
         # Calculate progress (inverted - more queries used = more progress)
-        progress = used / self.max_queries
+        progress = used / self.capacity
 
         # Show progress bar with color coding
         if remaining > 2:
@@ -96,3 +141,172 @@ class SimpleRateLimiter:
             st.warning(self.get_usage_message())
         else:
             st.error(self.get_usage_message())
+
+
+# Redis calls give up after this long, so an unreachable server can't stall the app
+REDIS_TIMEOUT_SECONDS = 1
+
+# Token-bucket check executed atomically inside Redis (one round-trip per call).
+# KEYS[1] = bucket key; ARGV = capacity, refill rate (tokens/sec), cost, TTL (ms).
+# A cost of 0 only reads the balance and a negative cost refunds tokens.
+# Returns {allowed (0/1), tokens remaining (as a string, to keep the fraction)}.
+_TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local ttl = tonumber(ARGV[4])
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'last_refill')
+local tokens = tonumber(state[1])
+local last_refill = tonumber(state[2])
+if tokens == nil or last_refill == nil then
+    tokens = capacity
+    last_refill = now
+end
+
+local elapsed = math.max(0, now - last_refill)
+tokens = math.min(capacity, tokens + elapsed * rate / 1000)
+
+local allowed = 0
+if tokens >= cost then
+    tokens = math.min(capacity, tokens - cost)
+    allowed = 1
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last_refill', now)
+redis.call('PEXPIRE', KEYS[1], ttl)
+return {allowed, tostring(tokens)}
+"""
+
+
+@st.cache_resource
+def _get_redis_client(redis_url):
+    """Returns a Redis client shared by all sessions of this Streamlit server."""
+    return redis.Redis.from_url(
+        redis_url,
+        socket_connect_timeout=REDIS_TIMEOUT_SECONDS,
+        socket_timeout=REDIS_TIMEOUT_SECONDS
+    )
+
+
+class RedisRateLimiter(SimpleRateLimiter):
+    """
+    A token-bucket rate limiter whose state lives in Redis.
+
+    Features:
+    - Same bucket semantics and UI as `SimpleRateLimiter`
+    - Keyed on the hashed client IP, so refreshing the browser doesn't reset the limit
+    - Refill and decrement run in a single Lua script, so concurrent requests
+      from several Streamlit workers/replicas can't overspend the bucket
+    - Fails closed by default: no queries are allowed while Redis is unreachable.
+      With `fallback_to_session=True` it degrades to a per-session bucket instead
+      (the `SimpleRateLimiter` behaviour) until Redis is back.
+
+    Create a new instance on every script run: the balance is read from Redis once
+    per instance and reused by the usage display, and after a Redis error the
+    instance stops calling Redis, so an outage costs at most one timeout per run.
+    """
+
+    def __init__(self, redis_url, capacity=5, refill_rate=5 / 3600, fallback_to_session=False):
+        """
+        Initialize the rate limiter.
+
+        Args:
+            redis_url (str): Redis connection URL (e.g., redis://localhost:6379/0)
+            capacity (int): Maximum number of queries that can be made in a burst
+            refill_rate (float): Number of queries regained per second
+            fallback_to_session (bool): Use a session-state bucket while Redis is
+                unreachable, instead of blocking all queries
+        """
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._fallback = SimpleRateLimiter(capacity, refill_rate) if fallback_to_session else None
+
+        client = _get_redis_client(redis_url)
+        self._script = client.register_script(_TOKEN_BUCKET_LUA)
+        self._key = f"rl:{_client_id()}"
+        self.backend_available = True
+        self._tokens = None  # Balance from the last script call (None until Redis is read)
+        # An idle bucket refills completely after this long, so it can expire
+        self._ttl_ms = math.ceil(capacity / refill_rate * 1000)
+
+    def _run(self, cost):
+        """
+        Runs the token-bucket script (via EVALSHA) with the given cost.
+
+        Returns:
+            tuple: (allowed (bool), tokens remaining (float)), or None if Redis
+            can't be reached (now or earlier in this run)
+        """
+        if not self.backend_available:
+            return None
+        try:
+            allowed, tokens = self._script(
+                keys=[self._key],
+                args=[self.capacity, self.refill_rate, cost, self._ttl_ms]
+            )
+        except redis.RedisError as e:
+            print(f"Error reaching Redis rate limiter: {e}")
+            self.backend_available = False
+            return None
+
+        self._tokens = float(tokens)
+        return bool(allowed), self._tokens
+
+    # While Redis is unreachable, each method either uses the session-state fallback
+    # or fails closed (rather than silently bypassing the limit during an outage)
+
+    def _refill(self):
+        # The balance only changes through this instance's own calls within a run
+        # (refill over a few seconds is negligible), so Redis is read at most once
+        if self._tokens is None:
+            self._run(0)
+        if not self.backend_available:
+            return self._fallback._refill() if self._fallback else 0.0
+        return self._tokens
+
+    def can_query(self):
+        result = self._run(1)
+        if result is None:
+            return self._fallback.can_query() if self._fallback else False
+        return result[0]
+
+    def refund(self):
+        if self._run(-1) is None and self._fallback:
+            self._fallback.refund()
+
+    def get_usage_message(self):
+        # Reading the balance also tells us whether Redis is reachable
+        self._refill()
+        if not self.backend_available and self._fallback is None:
+            return "⛔ Service temporarily unavailable. Please try again in a few minutes."
+        return super().get_usage_message()
+
+
+def _client_id():
+    """
+    Returns a stable, anonymized identifier for the current client.
+
+    Behind a proxy (e.g., Streamlit Cloud) this is the right-most X-Forwarded-For
+    entry, the one appended by the proxy itself; the entries to its left come from
+    the client and can be forged. Without the header, the socket's peer address is
+    used. Nothing else the client controls (like the User-Agent) is part of the key,
+    so it can't be varied to get a fresh bucket. The IP is hashed so raw IPs are
+    never stored in Redis.
+    """
+    forwarded_for = st.context.headers.get("X-Forwarded-For", "")
+    if forwarded_for.strip():
+        client_ip = forwarded_for.split(",")[-1].strip()
+    else:
+        client_ip = st.context.ip_address or ""
+    return hashlib.sha256(client_ip.encode()).hexdigest()[:16]
+
+
+def _format_wait(seconds):
+    """Formats a wait time in seconds as a short, human-readable string."""
+    if seconds < 60:
+        return f"{seconds} seconds"
+    return f"{math.ceil(seconds / 60)} minutes"
@@ -1,7 +1,26 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 from pinecone import Pinecone
-from . import config
+from . import compression, config
 from .llm_client import get_embedding_model
 
+# Query embeddings cached in memory (HyDE abstracts repeat across retries and identical queries)
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+
+# Shared Pinecone index, created on first use (see _get_clients)
+_index = None
+_index_lock = threading.Lock()
+
+# Dictionary for zstd-compressed chunk text, loaded on first use (see _get_zstd_dictionary)
+_zstd_dictionary = None
+_zstd_dictionary_lock = threading.Lock()
+
+# LRU cache of query embeddings: text -> embedding (as a tuple, so it can't be mutated)
+_query_embedding_cache = OrderedDict()
+_query_embedding_cache_lock = threading.Lock()
+
 
 # --- Helper Function ---
 def get_pinecone_index():
@@ -17,41 +36,102 @@ def get_pinecone_index():
         return None
 
 
-# --- Main Retrieval Function ---
-def fetch_relevant_patents(hyde_abstract: str, cpc_codes: list, top_k: int = 5):
+def _get_clients():
     """
-    Performs the Advanced Hybrid Retrieval.
+    Returns the shared (index, embedding_model) pair, creating them on first use.
 
-    1. Generates an embedding for the HyDE abstract.
-    2. Creates a metadata filter for the AI-generated CPC codes.
-    3. Queries Pinecone using both the vector and the filter.
+    Both clients hold pooled HTTPS connections, so reusing them avoids a new
+    TLS setup on every query. A client that failed to initialize (None) is
+    retried on the next call.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = get_pinecone_index()
+    return _index, get_embedding_model()
 
-    Args:
-        hyde_abstract (str): The AI-generated hypothetical abstract.
-        cpc_codes (list): A list of AI-generated CPC codes (e.g., ['G06N 3/08']).
-        top_k (int): The number of patents to retrieve.
+
+def _embed_queries(embedding_model, texts):
+    """
+    Embeds several queries, memoizing the results in an LRU cache.
+
+    All texts that aren't cached yet are sent in a single `embed_documents` call,
+    so N queries cost one OpenAI round-trip instead of N.
 
     Returns:
-        list: A list of retrieved patent contexts (dictionaries).
+        list: One embedding (list of floats) per text.
     """
-    print(f"--- Starting Retrieval ---")
-    print(f"  Querying with CPC Codes: {cpc_codes}")
+    embeddings = {}
+    with _query_embedding_cache_lock:
+        for text in texts:
+            if text in _query_embedding_cache:
+                _query_embedding_cache.move_to_end(text)
+                embeddings[text] = _query_embedding_cache[text]
 
-    # 1. Initialize dependencies
-    index = get_pinecone_index()
-    embedding_model = get_embedding_model()
+    misses = list(dict.fromkeys(text for text in texts if text not in embeddings))
+    if misses:
+        new_embeddings = embedding_model.embed_documents(misses)
+        with _query_embedding_cache_lock:
+            for text, embedding in zip(misses, new_embeddings):
+                embeddings[text] = _query_embedding_cache[text] = tuple(embedding)
+            while len(_query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+                _query_embedding_cache.popitem(last=False)
+
+    return [list(embeddings[text]) for text in texts]
 
-    if index is None or embedding_model is None:
-        return []  # Return empty if clients failed to init
 
-    # 2. Generate embedding for the HyDE abstract
+def _get_zstd_dictionary():
+    """
+    Loads the dictionary for zstd-compressed chunk text (None if it isn't configured
+    or the file doesn't exist yet). Only a loaded dictionary is kept, so a file that
+    is deployed after the app started is picked up without a restart.
+    """
+    global _zstd_dictionary
+    if not config.ZSTD_DICT_PATH:
+        return None
+    with _zstd_dictionary_lock:
+        if _zstd_dictionary is None:
+            _zstd_dictionary = compression.load_dictionary(config.ZSTD_DICT_PATH)
+        return _zstd_dictionary
+
+
+def _chunk_text(metadata):
+    """
+    Returns a match's chunk text, decompressing it if it was stored as 'text_zstd'.
+    A chunk that can't be decompressed yields '' instead of failing the whole query.
+    """
+    if "text_zstd" not in metadata:
+        return metadata.get('text', '')
+    dictionary = _get_zstd_dictionary()
+    if dictionary is None:
+        print("Error: Found compressed chunk text, but ZSTD_DICT_PATH is not set or missing.")
+        return ''
     try:
-        query_vector = embedding_model.embed_query(hyde_abstract)
-    except Exception as e:
-        print(f"Error generating query embedding: {e}")
-        return []
+        return compression.decompress_text(dictionary, metadata["text_zstd"])
+    except compression.DECOMPRESSION_ERRORS as e:
+        print(f"Error decompressing chunk text of patent {metadata.get('patent_id', '')}: {e}")
+        return ''
 
-    # 3. Create the metadata filter
+
+def normalize_cpc_codes(cpc_codes):
+    """
+    Reduces CPC codes to their distinct 4-character subclasses, the granularity
+    stored in the index (e.g., 'G06N 3/08' -> 'G06N').
+    """
+    return sorted({code.split()[0][:4].upper() for code in cpc_codes if code.strip()})
+
+
+def _query_index(index, query_vector, cpc_codes, top_k):
+    """
+    Queries Pinecone with a vector and a CPC code filter.
+
+    Returns:
+        list: A list of retrieved patent contexts (dictionaries).
+    """
+    cpc_codes = normalize_cpc_codes(cpc_codes)
+    print(f"  Querying with CPC Codes: {cpc_codes}")
+
+    # Create the metadata filter
     # This filter ensures we only search within the relevant CPC codes.
     # We use $in to match any document that has *at least one* of the predicted codes.
     if not cpc_codes:
@@ -64,7 +144,7 @@ def fetch_relevant_patents(hyde_abstract: str, cpc_codes: list, top_k: int = 5):
             }
         }
 
-    # 4. Query Pinecone (Hybrid Search)
+    # Query Pinecone (Hybrid Search)
     try:
         query_response = index.query(
             vector=query_vector,
@@ -77,13 +157,69 @@ def fetch_relevant_patents(hyde_abstract: str, cpc_codes: list, top_k: int = 5):
         print(f"Error querying Pinecone: {e}")
         return []
 
-    # 5. Format and return results
+    # Format and return results
     contexts = []
     for match in query_response.get('matches', []):
         contexts.append({
-            "text": match['metadata'].get('text', ''),
+            "text": _chunk_text(match['metadata']),
             "patent_id": match['metadata'].get('patent_id', ''),
             "score": match.get('score', 0)
         })
 
     return contexts
+
+
+# --- Main Retrieval Functions ---
+def fetch_relevant_patents_multi(queries: list):
+    """
+    Performs the Advanced Hybrid Retrieval for several queries at once.
+
+    1. Generates embeddings for all HyDE abstracts in a single request.
+    2. Creates a metadata filter for each query's AI-generated CPC codes.
+    3. Queries Pinecone with each vector and filter, in parallel.
+
+    Args:
+        queries (list): (hyde_abstract, cpc_codes, top_k) tuples, one per search.
+
+    Returns:
+        list: One list of retrieved patent contexts (dictionaries) per query.
+    """
+    print(f"--- Starting Retrieval ({len(queries)} queries) ---")
+    if not queries:
+        return []
+
+    # 1. Get the shared clients
+    index, embedding_model = _get_clients()
+
+    if index is None or embedding_model is None:
+        return [[] for _ in queries]  # Return empty if clients failed to init
+
+    # 2. Generate embeddings for the HyDE abstracts (one round-trip)
+    try:
+        query_vectors = _embed_queries(embedding_model, [hyde_abstract for hyde_abstract, _, _ in queries])
+    except Exception as e:
+        print(f"Error generating query embeddings: {e}")
+        return [[] for _ in queries]
+
+    # 3. Query Pinecone, one request per query, all in flight at once
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = [
+            executor.submit(_query_index, index, query_vector, cpc_codes, top_k)
+            for query_vector, (_, cpc_codes, top_k) in zip(query_vectors, queries)
+        ]
+        return [future.result() for future in futures]
+
+
+def fetch_relevant_patents(hyde_abstract: str, cpc_codes: list, top_k: int = 5):
+    """
+    Performs the Advanced Hybrid Retrieval for a single query.
+
+    Args:
+        hyde_abstract (str): The AI-generated hypothetical abstract.
+        cpc_codes (list): A list of AI-generated CPC codes (e.g., ['G06N']).
+        top_k (int): The number of patents to retrieve.
+
+    Returns:
+        list: A list of retrieved patent contexts (dictionaries).
+    """
+    return fetch_relevant_patents_multi([(hyde_abstract, cpc_codes, top_k)])[0]